@@ -0,0 +1,5 @@
+# audio_config.py - Audio settings shared by main.py and evaluator.py
+# Kept free of heavy imports so main.py can use it without loading the evaluator.
+
+# Sample rate of the mono float32 arrays passed to the evaluator as audio_ndarray
+AUDIO_SAMPLE_RATE = 16000
@@ -1,9 +1,11 @@
 # evaluator.py - Complete AI Evaluation Engine
-# Updated: Audio conversion + numpy serialization fix
+# Updated: Audio conversion via ffmpeg + in-memory audio arrays
 
 import re
 import io
 import os
+import shutil
+import subprocess
 import tempfile
 import numpy as np
 import librosa
@@ -14,33 +16,7 @@ from textblob import TextBlob
 import speech_recognition as sr
 from pydub import AudioSegment
 
-
-# ============================
-# NUMPY SERIALIZATION FIX
-# ============================
-def sanitize_for_json(obj):
-    """
-    Recursively convert numpy types to native Python types
-    so FastAPI can serialize the response to JSON.
-    """
-    if isinstance(obj, dict):
-        return {k: sanitize_for_json(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [sanitize_for_json(item) for item in obj]
-    elif isinstance(obj, tuple):
-        return tuple(sanitize_for_json(item) for item in obj)
-    elif isinstance(obj, np.integer):
-        return int(obj)
-    elif isinstance(obj, np.floating):
-        return float(obj)
-    elif isinstance(obj, np.ndarray):
-        return obj.tolist()
-    elif isinstance(obj, np.bool_):
-        return bool(obj)
-    elif isinstance(obj, (np.str_, np.bytes_)):
-        return str(obj)
-    else:
-        return obj
+from audio_config import AUDIO_SAMPLE_RATE
 
 
 # ============================
@@ -71,16 +47,24 @@ def convert_to_wav(audio_path: str) -> str:
         print(f"Converting {source_format} → WAV: {audio_path} "
               f"({os.path.getsize(audio_path)} bytes)")
 
-        audio = AudioSegment.from_file(audio_path, format=source_format)
-        audio = audio.set_channels(1)
-        audio = audio.set_frame_rate(16000)
-        audio = audio.set_sample_width(2)
-
         converted_path = os.path.join(
             os.path.dirname(audio_path),
             os.path.splitext(os.path.basename(audio_path))[0] + "_converted.wav"
         )
-        audio.export(converted_path, format="wav")
+
+        if shutil.which("ffmpeg"):
+            # Downmix, resample and requantize in one swresample pass
+            subprocess.run(
+                ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                 "-f", source_format, "-i", audio_path,
+                 "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "-sample_fmt", "s16",
+                 "-f", "wav", converted_path],
+                check=True, capture_output=True
+            )
+        else:
+            audio = AudioSegment.from_file(audio_path, format=source_format)
+            audio = audio.set_channels(1).set_frame_rate(AUDIO_SAMPLE_RATE).set_sample_width(2)
+            audio.export(converted_path, format="wav")
 
         print(f"Conversion successful: {converted_path} "
               f"({os.path.getsize(converted_path)} bytes)")
@@ -88,6 +72,8 @@ def convert_to_wav(audio_path: str) -> str:
         return converted_path
 
     except Exception as e:
+        if isinstance(e, subprocess.CalledProcessError):
+            e = e.stderr.decode(errors="ignore").strip() or e
         print(f"Audio conversion error: {e}")
         if converted_path and os.path.exists(converted_path):
             try:
@@ -97,6 +83,13 @@ def convert_to_wav(audio_path: str) -> str:
         return audio_path
 
 
+_EXT_FORMATS = {
+    "webm": "webm", "ogg": "ogg", "mp4": "mp4",
+    "m4a": "mp4", "mp3": "mp3", "wav": "wav",
+    "flac": "flac", "aac": "aac",
+}
+
+
 def _detect_format_from_header(header: bytes, filepath: str) -> str:
     """Detect audio format from file header bytes and extension."""
     if header[:4] == b"\x1aE\xdf\xa3":
@@ -111,13 +104,7 @@ def _detect_format_from_header(header: bytes, filepath: str) -> str:
         return "mp4"
 
     ext = filepath.rsplit(".", 1)[-1].lower() if "." in filepath else ""
-    ext_map = {
-        "webm": "webm", "ogg": "ogg", "mp4": "mp4",
-        "m4a": "mp4", "mp3": "mp3", "wav": "wav",
-        "flac": "flac", "aac": "aac",
-    }
-
-    detected = ext_map.get(ext, "webm")
+    detected = _EXT_FORMATS.get(ext, "webm")
     print(f"Format detected from extension: .{ext} → {detected}")
     return detected
 
@@ -125,23 +112,32 @@ def _detect_format_from_header(header: bytes, filepath: str) -> str:
 # ============================
 # SPEECH TO TEXT
 # ============================
-def transcribe_audio(audio_path: str) -> str:
-    """Convert audio file to text. Automatically converts non-WAV formats."""
+def transcribe_audio(audio_path: str, audio_ndarray: np.ndarray = None) -> str:
+    """
+    Convert audio to text. Uses the decoded 16 kHz mono samples when given,
+    otherwise converts the file at audio_path to WAV first.
+    """
     converted_path = None
 
     try:
         recognizer = sr.Recognizer()
-        wav_path = convert_to_wav(audio_path)
 
-        if wav_path != audio_path:
-            converted_path = wav_path
+        if audio_ndarray is not None:
+            pcm = (np.clip(audio_ndarray, -1.0, 1.0) * 32767).astype(np.int16)
+            audio_data = sr.AudioData(pcm.tobytes(), AUDIO_SAMPLE_RATE, 2)
+        else:
+            wav_path = convert_to_wav(audio_path)
+
+            if wav_path != audio_path:
+                converted_path = wav_path
 
-        with sr.AudioFile(wav_path) as source:
-            recognizer.adjust_for_ambient_noise(source, duration=0.5)
-            audio_data = recognizer.record(source)
-            text = recognizer.recognize_google(audio_data)
-            print(f"Transcribed: {text}")
-            return text
+            with sr.AudioFile(wav_path) as source:
+                recognizer.adjust_for_ambient_noise(source, duration=0.5)
+                audio_data = recognizer.record(source)
+
+        text = recognizer.recognize_google(audio_data)
+        print(f"Transcribed: {text}")
+        return text
 
     except sr.UnknownValueError:
         print("Speech Recognition: Could not understand audio")
@@ -353,15 +349,19 @@ def analyze_face(image_path: str) -> dict:
 # ============================
 # VOICE ANALYSIS
 # ============================
-def analyze_voice(audio_path: str, word_count: int) -> dict:
+def analyze_voice(audio_path: str, word_count: int,
+                  audio_ndarray: np.ndarray = None) -> dict:
     converted_path = None
 
     try:
-        wav_path = convert_to_wav(audio_path)
-        if wav_path != audio_path:
-            converted_path = wav_path
+        if audio_ndarray is not None:
+            y, sr_rate = audio_ndarray, AUDIO_SAMPLE_RATE
+        else:
+            wav_path = convert_to_wav(audio_path)
+            if wav_path != audio_path:
+                converted_path = wav_path
 
-        y, sr_rate = librosa.load(wav_path)
+            y, sr_rate = librosa.load(wav_path)
         duration = float(librosa.get_duration(y=y, sr=sr_rate))
 
         if duration < 1:
@@ -504,10 +504,11 @@ def generate_feedback(text_eval: dict, sentiment_data: dict,
 def evaluate_multimodal(answer_text: str, keywords: list, weight: float,
                         image_path: str, audio_path: str,
                         model_answer: str = "",
-                        category: str = "technical") -> dict:
+                        category: str = "technical",
+                        audio_ndarray: np.ndarray = None) -> dict:
     transcript = answer_text
     if not transcript or len(transcript.strip()) < 3:
-        transcript = transcribe_audio(audio_path)
+        transcript = transcribe_audio(audio_path, audio_ndarray)
 
     if not transcript or len(transcript.strip()) < 5:
         return _empty_response()
@@ -517,7 +518,7 @@ def evaluate_multimodal(answer_text: str, keywords: list, weight: float,
     face_data = analyze_face(image_path)
 
     word_count = len(transcript.split())
-    voice_data = analyze_voice(audio_path, word_count)
+    voice_data = analyze_voice(audio_path, word_count, audio_ndarray)
 
     skill_scores = calculate_skill_scores(
         text_eval, sentiment_data, face_data, voice_data, category
@@ -565,8 +566,8 @@ def evaluate_multimodal(answer_text: str, keywords: list, weight: float,
         }
     }
 
-    # ✅ Final safety net: sanitize ALL numpy types
-    return sanitize_for_json(result)
+    # Every value above is already cast to a native Python type
+    return result
 
 
 def _empty_response():
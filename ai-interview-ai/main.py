@@ -1,26 +1,39 @@
-# main.py - Synchronous Version (Compatible with Frontend)
+# main.py - Async Version (Compatible with Frontend)
 
 import os
-import io
+import asyncio
+import bisect
 import uuid
-import json
 import shutil
+import subprocess
 import random
 import base64
-from typing import Optional
-
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+
+import aiofiles
+import numpy as np
+import orjson
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from pydub import AudioSegment
 from pypdf import PdfReader
 
 from question_bank import QUESTION_BANK
-from evaluator import evaluate_multimodal, sanitize_for_json
+from audio_config import AUDIO_SAMPLE_RATE
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Shutdown: persist buffered scores and clear scratch files
+    flush_all_scores()
 
 app = FastAPI(
     title="AI Interview Evaluation Service",
-    version="2.2.0"
+    version="2.2.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -32,10 +45,40 @@ app.add_middleware(
 
 SESSIONS_DIR = "saved_sessions"
 TEMP_DIR = "temp_eval"
+UPLOAD_CHUNK_SIZE = 1 << 20
+SESSION_FLUSH_DELAY = 0.5
+SESSION_FLUSH_EVERY = int(os.getenv("SESSION_FLUSH_EVERY", "5"))
+SESSION_CACHE_SIZE = 1024
+
+# In-process session state; a session sticks to one worker for the whole interview
+SESSION_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+_SESSION_LOCKS: dict[str, asyncio.Lock] = {}
+_PENDING_SCORES: dict[str, list] = {}
+_FLUSH_TASKS: dict[str, asyncio.Task] = {}
+
+# Caps concurrent evaluations so threads don't oversubscribe the model libraries
+EVAL_SEMAPHORE = asyncio.Semaphore(os.cpu_count() or 1)
 
 os.makedirs(SESSIONS_DIR, exist_ok=True)
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Percentage cut-offs; GRADES[i] applies below GRADE_THRESHOLDS[i]
+GRADE_THRESHOLDS = (40, 50, 60, 70, 80, 90)
+GRADES = ("F", "D", "C", "B", "B+", "A", "A+")
+SKILL_KEYS = ("technical", "communication", "problem_solving", "confidence")
+LEVEL_ROUNDS = {"easy": "round_1_background", "medium": "round_2_domain", "hard": "round_3_project"}
+
+# Question pool per (domain, level), flattened once at import instead of per /interview/start
+FLATTENED_QUESTIONS = {
+    (domain, level): tuple(
+        q
+        for r in ([LEVEL_ROUNDS[level]] if level in LEVEL_ROUNDS else rounds)
+        for q in rounds[r]
+    )
+    for domain, rounds in QUESTION_BANK.items()
+    for level in ("all", *LEVEL_ROUNDS)
+}
+
 # -------------------------
 # ROOT ROUTE (Fixes "Not Found")
 # -------------------------
@@ -55,49 +98,253 @@ async def health():
 # Models
 # -------------------------
 class StartRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True, str_strip_whitespace=True)
+
     domain: str
-    level: Optional[str] = "all"
+    level: Optional[Literal["all", "easy", "medium", "hard"]] = "all"
 
 # -------------------------
 # Helpers
 # -------------------------
-def save_session(session_id, data):
-    path = os.path.join(SESSIONS_DIR, f"{session_id}.json")
-    with open(path, "w") as f:
-        json.dump(sanitize_for_json(data), f, indent=4)
-
-def load_session(session_id):
-    path = os.path.join(SESSIONS_DIR, f"{session_id.strip()}.json")
-    if os.path.exists(path):
-        with open(path, "r") as f:
-            return json.load(f)
-    return None
+def _session_path(session_id, suffix):
+    return os.path.join(SESSIONS_DIR, f"{session_id.strip()}{suffix}")
+
+async def save_session(session_id, data):
+    """Cache the session and write everything except the scores, which live in the JSONL sidecar."""
+    _cache_session(session_id, data)
+    await asyncio.to_thread(_write_meta, session_id, data)
+
+def _write_meta(session_id, data):
+    """Atomically write everything except the scores to <id>.meta.json."""
+    meta = {k: v for k, v in data.items() if k != "scores"}
+    path = _session_path(session_id, ".meta.json")
+    tmp_path = path + ".tmp"
+    # OPT_SERIALIZE_NUMPY covers numpy scalars/arrays, so no sanitize pass is needed
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(meta, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+        f.flush()
+        os.fsync(f.fileno())
+    # Atomic swap so a crash mid-write never leaves a truncated session
+    os.replace(tmp_path, path)
+
+def record_score(session_id, session, score):
+    """Add a score in memory; flush to the JSONL sidecar every SESSION_FLUSH_EVERY answers."""
+    session["scores"].append(score)
+    pending = _PENDING_SCORES.setdefault(session_id, [])
+    pending.append(score)
+    # Interim writes only matter for crash recovery; the final answer is flushed on eviction
+    if len(pending) < SESSION_FLUSH_EVERY:
+        return
+
+    task = _FLUSH_TASKS.pop(session_id, None)
+    if task: task.cancel()
+    _FLUSH_TASKS[session_id] = asyncio.create_task(_flush_later(session_id))
+
+def flush_scores(session_id):
+    """Append any pending scores as JSON lines so each answer costs O(1) bytes written."""
+    task = _FLUSH_TASKS.pop(session_id, None)
+    if task and task is not asyncio.current_task(): task.cancel()
+
+    pending = _PENDING_SCORES.pop(session_id, None)
+    if not pending:
+        return
+    with open(_session_path(session_id, ".scores.jsonl"), "ab") as f:
+        for score in pending:
+            f.write(orjson.dumps(score, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")
+
+async def _flush_later(session_id):
+    await asyncio.sleep(SESSION_FLUSH_DELAY)
+    flush_scores(session_id)
+
+def evict_session(session_id):
+    flush_scores(session_id)
+    remove_session_temp_files(session_id)
+    SESSION_CACHE.pop(session_id, None)
+    _SESSION_LOCKS.pop(session_id, None)
+
+def flush_all_scores():
+    for session_id in list(_PENDING_SCORES):
+        flush_scores(session_id)
+    for session_id in list(SESSION_CACHE):
+        remove_session_temp_files(session_id)
+
+def session_lock(session_id):
+    return _SESSION_LOCKS.setdefault(session_id, asyncio.Lock())
+
+def _cache_session(session_id, data):
+    if session_id not in SESSION_CACHE and len(SESSION_CACHE) >= SESSION_CACHE_SIZE:
+        # Least recently used goes first, skipping sessions mid-evaluation;
+        # its pending scores are flushed before dropping it
+        idle = next((sid for sid in SESSION_CACHE
+                     if not (sid in _SESSION_LOCKS and _SESSION_LOCKS[sid].locked())), None)
+        if idle: evict_session(idle)
+    SESSION_CACHE[session_id] = data
+    SESSION_CACHE.move_to_end(session_id)
+
+def _read_scores(session_id, repair=False):
+    """Read the JSONL sidecar, skipping lines torn by a crash mid-append."""
+    scores_path = _session_path(session_id, ".scores.jsonl")
+    if not os.path.exists(scores_path):
+        return []
+    with open(scores_path, "rb") as f:
+        lines = f.read().split(b"\n")
+
+    scores = []
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            scores.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            print(f"Skipping unreadable score line {i + 1} in {scores_path}")
+            if repair and i == len(lines) - 1:
+                # Cut the torn tail so the next append starts on a clean line
+                with open(scores_path, "r+b") as f:
+                    f.truncate(sum(len(l) + 1 for l in lines[:i]))
+    return scores
+
+def load_session(session_id, cache=True):
+    """Return the live session; cache=False reads without touching the cache (read-only callers)."""
+    session_id = session_id.strip()
+    if session_id in SESSION_CACHE:
+        if cache: SESSION_CACHE.move_to_end(session_id)
+        return SESSION_CACHE[session_id]
+
+    meta_path = _session_path(session_id, ".meta.json")
+    if not os.path.exists(meta_path):
+        # Sessions saved before the meta/JSONL split are a single <id>.json with scores inline
+        legacy_path = _session_path(session_id, ".json")
+        if not os.path.exists(legacy_path):
+            return None
+        with open(legacy_path, "rb") as f:
+            session = orjson.loads(f.read())
+        session.setdefault("scores", [])
+        if cache:
+            # About to be written to again: split into meta + JSONL so new scores aren't lost
+            # A sidecar left by an interrupted earlier migration is rebuilt, not appended to
+            scores_path = _session_path(session_id, ".scores.jsonl")
+            if os.path.exists(scores_path): os.remove(scores_path)
+            _PENDING_SCORES[session_id] = list(session["scores"])
+            flush_scores(session_id)
+            _write_meta(session_id, session)
+            # Only drop the legacy file once the meta file is safely in place
+            os.remove(legacy_path)
+            _cache_session(session_id, session)
+        return session
+
+    with open(meta_path, "rb") as f:
+        session = orjson.loads(f.read())
+
+    session["scores"] = _read_scores(session_id, repair=cache)
+    if cache: _cache_session(session_id, session)
+    return session
+
+def json_response(data):
+    """Serialize with orjson (numpy handled natively), skipping FastAPI's jsonable_encoder walk."""
+    return Response(
+        content=orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS),
+        media_type="application/json"
+    )
+
+def session_temp_paths(session_id):
+    """Fixed per-session (image, audio upload) paths, reused for every answer."""
+    return (os.path.join(TEMP_DIR, f"{session_id}.jpg"),
+            os.path.join(TEMP_DIR, f"{session_id}.upload"))
+
+def remove_session_temp_files(session_id):
+    for path in session_temp_paths(session_id):
+        if os.path.exists(path): os.remove(path)
 
 def check_ffmpeg():
     if not shutil.which("ffmpeg"):
         # Log warning but don't crash, pydub might fallback
         print("WARNING: FFmpeg not found on server path")
-
-def save_uploaded_audio_as_wav(upload: UploadFile, audio_bytes: bytes) -> str:
-    check_ffmpeg()
-    wav_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}.wav")
+        return False
+    return True
+
+async def save_upload_to_file(upload: UploadFile, path: str) -> int:
+    """Copy an upload to disk in 1 MiB chunks; returns the number of bytes written."""
+    size = 0
+    async with aiofiles.open(path, "wb") as f:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+            size += len(chunk)
+    return size
+
+AUDIO_MAGIC = {
+    b"\x1aE\xdf\xa3": "webm", b"OggS": "ogg", b"fLaC": "flac",
+    b"ID3": "mp3", b"\xff\xfb": "mp3", b"RIFF": "wav",
+}
+AUDIO_CONTENT_TYPES = {
+    "audio/webm": "webm", "video/webm": "webm", "audio/ogg": "ogg",
+    "audio/wav": "wav", "audio/x-wav": "wav", "audio/wave": "wav",
+    "audio/mpeg": "mp3", "audio/mp4": "mp4", "audio/x-m4a": "mp4",
+    "audio/flac": "flac",
+}
+AUDIO_EXTENSIONS = {".wav": "wav", ".mp3": "mp3", ".m4a": "mp4"}
+
+def _detect_upload_format(upload: UploadFile, header: bytes) -> str:
+    """Detect audio container from magic bytes, then content type, then filename."""
+    for prefix, fmt in AUDIO_MAGIC.items():
+        if header.startswith(prefix):
+            return fmt
+    if header[4:8] == b"ftyp":
+        return "mp4"
+
+    content_type = (upload.content_type or "").split(";", 1)[0].strip().lower()
+    fmt = AUDIO_CONTENT_TYPES.get(content_type)
+    if fmt:
+        return fmt
+
+    # Detect format from filename or assume webm
+    ext = os.path.splitext(upload.filename or "")[1].lower()
+    return AUDIO_EXTENSIONS.get(ext, "webm")
+
+def decode_uploaded_audio(upload: UploadFile, input_path: str) -> Optional[np.ndarray]:
+    """Decode an upload to 16 kHz mono float32 samples, or None if decoding fails."""
+    has_ffmpeg = check_ffmpeg()
+    with open(input_path, "rb") as f:
+        fmt = _detect_upload_format(upload, f.read(12))
     try:
-        # Detect format from filename or assume webm
-        fmt = "webm"
-        if upload.filename.lower().endswith(".wav"): fmt = "wav"
-        if upload.filename.lower().endswith(".mp3"): fmt = "mp3"
-        if upload.filename.lower().endswith(".m4a"): fmt = "m4a"
-
-        audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format=fmt)
-        audio = audio.set_channels(1).set_frame_rate(16000).set_sample_width(2)
-        audio.export(wav_path, format="wav")
+        if has_ffmpeg:
+            # Let ffmpeg decode + downmix + resample in one native pass
+            proc = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-loglevel", "error",
+                 "-f", fmt, "-i", input_path,
+                 "-f", "s16le", "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "pipe:1"],
+                check=True, capture_output=True
+            )
+            pcm = np.frombuffer(proc.stdout, dtype=np.int16)
+        else:
+            audio = AudioSegment.from_file(input_path, format=fmt)
+            audio = audio.set_channels(1).set_frame_rate(AUDIO_SAMPLE_RATE).set_sample_width(2)
+            pcm = np.array(audio.get_array_of_samples(), dtype=np.int16)
     except Exception as e:
+        if isinstance(e, subprocess.CalledProcessError):
+            e = e.stderr.decode(errors="ignore").strip() or e
         print(f"Audio conversion error: {e}")
-        # Fallback: save raw bytes if conversion fails
-        with open(wav_path, "wb") as f:
-            f.write(audio_bytes)
-            
-    return wav_path
+        return None
+
+    return pcm.astype(np.float32) / 32768.0
+
+async def to_thread_uncancellable(func, *args, **kwargs):
+    """
+    asyncio.to_thread, but a cancelled caller still waits for the thread to finish.
+    The thread can't be interrupted and reads the session's fixed temp files, so the
+    lock, semaphore slot and files must stay held until it is done.
+    """
+    task = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await asyncio.wait({task})
+        raise
+
+def run_evaluation(**kwargs):
+    # Imported on first use so DeepFace/TF/librosa load in a worker thread,
+    # not at startup; /health and session routes never pay for them
+    from evaluator import evaluate_multimodal
+    return evaluate_multimodal(**kwargs)
 
 # -------------------------
 # Start Interview
@@ -110,21 +357,10 @@ async def start(req: StartRequest):
     if domain_key not in QUESTION_BANK:
         domain_key = "backend"
 
-    raw_rounds = QUESTION_BANK[domain_key]
-    flattened_questions = []
-
     # Filter logic
-    if req.level and req.level != "all":
-        level_map = {"easy": "round_1_background", "medium": "round_2_domain", "hard": "round_3_project"}
-        rk = level_map.get(req.level)
-        if rk: flattened_questions = list(raw_rounds[rk])
-        else:
-            for r in raw_rounds: flattened_questions.extend(raw_rounds[r])
-    else:
-        for r in raw_rounds: flattened_questions.extend(raw_rounds[r])
-
-    random.shuffle(flattened_questions)
-    if req.level == "all": flattened_questions = flattened_questions[:10]
+    questions = FLATTENED_QUESTIONS[(domain_key, req.level or "all")]
+    count = min(10, len(questions)) if req.level == "all" else len(questions)
+    flattened_questions = random.sample(questions, count)
 
     session_data = {
         "session_id": session_id,
@@ -134,7 +370,7 @@ async def start(req: StartRequest):
         "scores": [],
         "total_questions": len(flattened_questions)
     }
-    save_session(session_id, session_data)
+    await save_session(session_id, session_data)
 
     # Return safe questions (no model answer)
     safe_q = [{"q": q["q"], "category": q.get("category", "technical")} for q in flattened_questions]
@@ -153,8 +389,7 @@ async def start(req: StartRequest):
 async def start_resume(file: UploadFile = File(...)):
     session_id = str(uuid.uuid4())
     pdf_path = os.path.join(TEMP_DIR, f"{session_id}.pdf")
-    content = await file.read()
-    with open(pdf_path, "wb") as f: f.write(content)
+    await save_upload_to_file(file, pdf_path)
 
     try:
         reader = PdfReader(pdf_path)
@@ -191,13 +426,13 @@ async def start_resume(file: UploadFile = File(...)):
         "scores": [],
         "total_questions": len(questions)
     }
-    save_session(session_id, session_data)
+    await save_session(session_id, session_data)
     if os.path.exists(pdf_path): os.remove(pdf_path)
 
     return {"session_id": session_id, "total_questions": len(questions)}
 
 # -------------------------
-# Evaluate (Synchronous)
+# Evaluate
 # -------------------------
 @app.post("/interview/evaluate")
 async def evaluate(
@@ -207,62 +442,81 @@ async def evaluate(
     image: UploadFile = File(...),
     audio: UploadFile = File(...)
 ):
+    session_id = session_id.strip()
     session = load_session(session_id)
     if not session: raise HTTPException(404, "Session not found")
 
+    # One answer at a time per session so scores land in order
+    async with session_lock(session_id):
+        try:
+            return await _evaluate_answer(session_id, session, index, answer_text, image, audio)
+        except BaseException:
+            # The temp files only serve this request; don't leave them behind on failure
+            remove_session_temp_files(session_id)
+            raise
+
+async def _evaluate_answer(session_id, session, index, answer_text, image, audio):
     q_data = session["questions"][int(index)]
 
-    # Save Files
-    img_bytes = await image.read()
-    img_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}.jpg")
-    with open(img_path, "wb") as f: f.write(img_bytes)
+    # Save Files (truncated and rewritten in place on every answer)
+    img_path, upload_path = session_temp_paths(session_id)
+    await save_upload_to_file(image, img_path)
 
-    audio_bytes = await audio.read()
     audio_path = ""
-    if len(audio_bytes) > 100:
-        audio_path = save_uploaded_audio_as_wav(audio, audio_bytes)
-
-    try:
-        # Run AI Evaluation (Blocking)
-        eval_res = evaluate_multimodal(
+    audio_ndarray = None
+    if await save_upload_to_file(audio, upload_path) > 100:
+        audio_ndarray = await to_thread_uncancellable(decode_uploaded_audio, audio, upload_path)
+        # Fallback: let the evaluator try the raw upload if decoding fails
+        if audio_ndarray is None: audio_path = upload_path
+
+    # Run AI Evaluation off the event loop, at most one per CPU at a time
+    async with EVAL_SEMAPHORE:
+        result = await to_thread_uncancellable(
+            run_evaluation,
             answer_text=answer_text,
             keywords=q_data.get("keywords", []),
             weight=q_data.get("weight", 1.0),
             image_path=img_path,
             audio_path=audio_path,
-            model_answer=q_data.get("model_answer", "")
+            model_answer=q_data.get("model_answer", ""),
+            audio_ndarray=audio_ndarray
         )
 
-        result = sanitize_for_json(eval_res)
-        session["scores"].append(result)
-
-        # Check Finished
-        is_finished = int(index) >= len(session["questions"]) - 1
-        final_summary = None
-
-        if is_finished:
-            # Simple average logic for summary
-            total = sum(s["overall_marks"] for s in session["scores"])
-            final_summary = {
-                "total_marks": total,
-                "percentage": (total / (len(session["questions"]) * 10)) * 100,
-                "grade": "A" if total > 40 else "B"
-            }
-            session["final_result"] = final_summary
-
-        save_session(session_id, session)
-
-        return {
-            "finished": is_finished,
-            "current_score": result,
-            "final_result": final_summary
-        }
+    record_score(session_id, session, result)
+
+    # Check Finished
+    is_finished = int(index) >= len(session["questions"]) - 1
+    final_summary = None
 
-    finally:
-        # Cleanup
-        if os.path.exists(img_path): os.remove(img_path)
-        if audio_path and os.path.exists(audio_path): os.remove(audio_path)
+    if is_finished:
+        # Simple average logic for summary
+        total = sum(s["overall_marks"] for s in session["scores"])
+        emotions = [s["emotion_detected"] for s in session["scores"]
+                    if s.get("emotion_detected") not in (None, "unknown", "none")]
+        skill_matrix = np.array(
+            [[s.get("skill_scores", {}).get(k, 0) for k in SKILL_KEYS] for s in session["scores"]],
+            dtype=np.float32
+        )
+        skill_averages = {k: round(float(v), 1) for k, v in zip(SKILL_KEYS, skill_matrix.mean(axis=0))}
+        percentage = (total / (len(session["questions"]) * 10)) * 100
+        final_summary = {
+            "total_marks": total,
+            "percentage": percentage,
+            "skill_averages": skill_averages,
+            "dominant_emotion": Counter(emotions).most_common(1)[0][0] if emotions else "neutral",
+            "grade": GRADES[bisect.bisect_right(GRADE_THRESHOLDS, percentage)]
+        }
+        session["final_result"] = final_summary
+        # Persist before returning; evicting flushes the pending scores and removes temp files
+        await save_session(session_id, session)
+        evict_session(session_id)
+
+    return json_response({
+        "finished": is_finished,
+        "current_score": result,
+        "final_result": final_summary
+    })
 
 @app.get("/interview/session/{session_id}")
 async def get_session(session_id: str):
-    return load_session(session_id)
\ No newline at end of file
+    return json_response(load_session(session_id, cache=False))
\ No newline at end of file